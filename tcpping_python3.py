@@ -4,44 +4,111 @@
 # Modified for Python 3 compatibility
 
 import argparse
+import array
+import errno
+import functools
+import itertools
+import os
+import select
 import time
 import socket
 import struct
+import math
 import logging
 import logging.handlers
+import queue
 import signal
-import random
+import sys
+import statistics
 from datetime import datetime
 
 __VERSION__ = '0.3.2'
 
+# 一次计时（两次取时间戳）本身的开销，单位纳秒，启动时由 calibrate_timer_overhead 校准
+_TIMER_OVERHEAD_NS = 0
+
+# 热路径上常用函数的模块级别名，省去每次的属性查找
+_pc = time.perf_counter_ns
+_sleep = time.sleep
+_socket = socket.socket
+_poll = getattr(select, 'poll', None)
+# 循环节奏控制只需要粗粒度时钟：Linux下CLOCK_MONOTONIC_COARSE
+# 直接读取用户态变量，不进内核；time 模块没有导出该常量，
+# 这里直接使用Linux的时钟编号6。其它平台退回time.monotonic
+_coarse_now, _COARSE_RES = time.monotonic, 0.0
+if sys.platform.startswith('linux'):
+    _coarse_clock = getattr(time, 'CLOCK_MONOTONIC_COARSE', 6)
+    try:
+        _COARSE_RES = time.clock_getres(_coarse_clock)
+        _coarse_now = functools.partial(time.clock_gettime, _coarse_clock)
+    except OSError:
+        _coarse_now, _COARSE_RES = time.monotonic, 0.0
+# 创建时直接带上 SOCK_CLOEXEC，省去一次 fcntl 调用（非 Linux 平台没有该常量）
+_SOCK_STREAM_CLOEXEC = socket.SOCK_STREAM | getattr(socket, 'SOCK_CLOEXEC', 0)
+# ResultBucket 预分配样本数组的上限（8MB），更多的样本运行中追加
+_SAMPLES_PREALLOC_MAX = 1 << 20
+# 非阻塞 connect 正在进行中的返回码（Windows 下为 WSAEWOULDBLOCK）
+_CONNECT_PENDING = (errno.EINPROGRESS, getattr(errno, 'WSAEWOULDBLOCK', errno.EINPROGRESS))
+
 def current_time():
     """Return current time as formatted string."""
     t = datetime.fromtimestamp(time.time())
     return t.strftime('%Y%m%d-%H:%M:%S')
 
-def conn_tcp(dst_host, dst_port, timeout, src_host=None, src_port=None, rst=False, reuse=False, delay_close_second=0):
+def wait_writable(s, timeout):
+    """
+    等待非阻塞connect完成（成功或失败），优先使用poll，没有poll的平台退回select
+    Windows下connect失败只会出现在exceptfds中，因此select同时监听可写和异常，
+    具体结果由调用方读取SO_ERROR判断
+    :param s: socket对象
+    :param timeout: 超时时间（秒），None表示一直等待
+    :return: 是否在超时前connect已有结果
+    """
+    if _poll is not None:
+        p = _poll()
+        p.register(s, select.POLLOUT)
+        return bool(p.poll(None if timeout is None else timeout * 1000))
+    _, writable, failed = select.select((), (s,), (s,), timeout)
+    return bool(writable or failed)
+
+def calibrate_timer_overhead(iterations=100_000):
+    """
+    校准计时器开销：连续取两次时间戳，取差值的中位数作为一次计时的固有开销
+    :param iterations: 采样次数
+    :return: 计时开销，单位纳秒
+    """
+    pc = _pc
+    samples = []
+    for _ in range(iterations):
+        a = pc()
+        b = pc()
+        samples.append(b - a)
+    return int(statistics.median(samples))
+
+def conn_tcp(dst_addr, timeout, src_host=None, src_port=None, rst=False, reuse=False, delay_close_second=0):
     """
-    Open a TCP connection to host:port
-    Return conn time, close time and error (if exist)
-    :param dst_host: remote host
-    :param dst_port: remote port
+    Open a TCP connection to dst_addr
+    Return conn time, close time (both in integer nanoseconds) and error (if exist)
+    :param dst_addr: remote sockaddr as returned by getaddrinfo, i.e. (ip, port)
     :param src_host: local host
     :param src_port: local port
     :param rst: if set, use RESET to close connection
     :param timeout: wait TIMEOUT second in connection period
     :param reuse: if set, allow reuse of local address
     :param delay_close_second: delay before closing the connection
-    :return: (conn_time, close_time, err, local_addr), connection time, close time, error message, and local address
+    :return: (conn_ns, close_ns, err, local_addr), connection time, close time, error message, and local address
+             (local_addr is None on success unless src_host or src_port is set)
     """
-    t1, t2, t3, te, conn_time, close_time, err, local_addr = -1, -1, -1, -1, -1, -1, '', None
+    t1, t2, t3, te, conn_ns, close_ns, err, local_addr = -1, -1, -1, -1, -1, -1, '', None
     
     # 若指定了RST参数，那么开始设定相关参数
     if rst:
         l_onoff, l_linger = 1, 0
     
+    # socket创建失败时 s 仍为 None，closed 记录成功路径上是否已经关闭过
+    s, closed = None, False
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s = _socket(socket.AF_INET, _SOCK_STREAM_CLOEXEC)
         # 开始设定发送RST需要的参数
         if rst:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
@@ -51,48 +118,72 @@ def conn_tcp(dst_host, dst_port, timeout, src_host=None, src_port=None, rst=Fals
         if reuse:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         if src_host and src_port and src_port < 65536:
-            s.bind((src_host, int(src_port)))
+            s.bind((src_host, src_port))
         
-        t1 = time.time()
-        s.settimeout(timeout)
-        s.connect((dst_host, int(dst_port)))
-        local_addr = s.getsockname()
-        t2 = time.time()
+        # 使用非阻塞connect，计时只覆盖三次握手本身
+        s.setblocking(False)
+        t1 = _pc()
+        rc = s.connect_ex(dst_addr)
+        if rc in _CONNECT_PENDING:
+            if not wait_writable(s, timeout):
+                raise socket.timeout('timed out')
+            tc = _pc()
+            rc = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        else:
+            tc = _pc()
+        if rc:
+            # 握手失败（如被RST拒绝），以握手结束的时间作为出错时间
+            te = tc
+            raise OSError(rc, os.strerror(rc))
+        t2 = tc
+        # 只有指定了源地址或源端口时才关心本地地址，否则省掉一次 getsockname 调用
+        if src_host or src_port:
+            local_addr = s.getsockname()
         # 延迟指定的秒数关闭
-        time.sleep(delay_close_second)
+        _sleep(delay_close_second)
         s.close()
-        t3 = time.time()
+        closed = True
+        t3 = _pc()
     except Exception as e:
-        local_addr = s.getsockname()
+        if s is not None and not closed:
+            local_addr = s.getsockname()
         err = e
-        te = time.time()
+        if te < 0:
+            te = _pc()
     finally:
-        try:
-            # finally块中就不延迟关闭了
-            s.close()
-        except Exception as e2:
-            print(e2)
+        if s is not None and not closed:
+            try:
+                # finally块中就不延迟关闭了
+                s.close()
+            except OSError as e2:
+                mylogger.debug('close err: %s', e2)
 
-    # 计算连接时间和关闭时间
+    # 计算连接时间和关闭时间，全程使用整数纳秒，连接时间扣除计时器本身的开销
     if t2 >= 0:
-        conn_time = t2 - t1
+        conn_ns = max(0, (t2 - t1) - _TIMER_OVERHEAD_NS)
     if t3 >= 0:
-        close_time = t3 - t2
+        close_ns = t3 - t2
     if te >= 0:
         if t2 >= 0:
-            conn_time = t2 - t1
-            close_time = t3 - t2
-        else:
-            conn_time = te - t1
-    return (conn_time, close_time, err, local_addr)
+            conn_ns = max(0, (t2 - t1) - _TIMER_OVERHEAD_NS)
+            close_ns = t3 - t2
+        elif t1 >= 0:
+            conn_ns = max(0, (te - t1) - _TIMER_OVERHEAD_NS)
+    return (conn_ns, close_ns, err, local_addr)
 
-def judge_count(count):
+def rotate_ports(start):
     """
-    判断是否继续执行
-    :param count: 剩余执行次数
-    :return: 是否继续执行
+    生成自增的源端口序列，超过65535后从1024重新开始
+    :param start: 起始源端口
+    :return: 源端口生成器
     """
-    return count > 0 if count is not None else True
+    port = start
+    while True:
+        yield port
+        port += 1
+        if port >= 65536:
+            mylogger.warning('Local port reached 65535, resetting src port to 1024.')
+            port = 1024
 
 def judge_args(argument):
     """
@@ -101,9 +192,16 @@ def judge_args(argument):
     :return: 参数是否合法
     """
     if bool(argument.src_host) ^ (bool(argument.src_port) or bool(argument.src_rotate_port)):
-        # 随机出一个源端口，注意这里没有校验，可能会失败（比如源端口已经被占用）
-        argument.src_port = random.randint(10000, 60000)
-        tip = f'Missing src_port or src_rotate_port. A random local port will be given: {argument.src_port}'
+        # 用一个临时socket绑定到0端口，由内核从临时端口范围中挑选一个当前可用的源端口
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+                probe.bind((argument.src_host or '', 0))
+                argument.src_port = probe.getsockname()[1]
+        except OSError as e:
+            mylogger.error(f'Cannot pick a local port on {argument.src_host}: {e}')
+            return False
+        tip = 'Missing src_port or src_rotate_port. ' \
+              f'A free local port chosen by the kernel will be given: {argument.src_port}'
         mylogger.warning(tip)
     return True
 
@@ -134,46 +232,61 @@ def go(dst_host, dst_port, timeout, interval, src_host=None, src_port=None, src_
     :param count: 执行次数
     :param delay_close_second: 延迟关闭时间
     """
-    error_flag = False
-    if src_rotate_port:
-        src_port = src_rotate_port
-
-    while judge_count(count):
-        conn_time, close_time, err, local_addr = conn_tcp(dst_host, dst_port, timeout=timeout, src_host=src_host,
-                                                          src_port=src_port, rst=rst, reuse=reuse,
-                                                          delay_close_second=delay_close_second)
-        result.put(conn_time, not bool(err))
-        
-        # 初始化存放输出信息的列表
-        output = []
-        if local_addr:
-            output.append(f'{local_addr[0]}:{local_addr[1]}')
-        output.append(f'{dst_host}:{dst_port}')
-        if conn_time >= 0:
-            output.append(f'conn_time: {conn_time:.6f}')
-        if len(str(err)) > 0:
-            error_flag = True
-            output.append(f'ERROR: {err}')
-
-        final_output = ', '.join(output)
-        mylogger.error(final_output) if error_flag else mylogger.info(final_output)
-
-        # 清除错误标志，执行本次循环的收尾工作
-        error_flag = False
-
-        # 检查是否需要源端口自增
-        if src_rotate_port:
-            src_port += 1
-            if src_port >= 65536:
-                mylogger.warning('Local port reached 65535, resetting src port to 1024.')
-                src_port = 1024
-
-        # 若有 count，自减1
-        if count is not None:
-            count -= 1
-
-        # 连接间隔
-        time.sleep(interval)
+    # 端口在循环外转换一次，conn_tcp 内不再重复转换
+    dst_port = int(dst_port)
+    # 目标地址只在开始时解析一次，直接复用解析得到的sockaddr，
+    # 避免每次连接都重新解析地址
+    try:
+        dst_addr = socket.getaddrinfo(dst_host, dst_port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+    except socket.gaierror as e:
+        mylogger.error(f'{dst_host}:{dst_port}, ERROR: {e}')
+        return
+
+    # 输出模板和日志函数在循环外准备好，循环内只做一次格式化
+    dst = f'{dst_host}:{dst_port}'
+    tmpl_ok = '{la}{dst}, conn_time: {ct:.6f}'
+    tmpl_err = '{la}{dst}, conn_time: {ct:.6f}, ERROR: {err}'
+    # 还没开始连接就出错（如bind失败）时没有连接时间
+    tmpl_err_early = '{la}{dst}, ERROR: {err}'
+    log_ok, log_err = mylogger.info, mylogger.error
+    info_enabled = mylogger.isEnabledFor(logging.INFO)
+    error_enabled = mylogger.isEnabledFor(logging.ERROR)
+
+    # 循环内用到的函数绑定为局部变量，conn_tcp 按位置传参，
+    # 减少每轮的全局查找和关键字参数处理
+    ping, put, sleep = conn_tcp, result.put, _sleep
+    # 间隔小于粗粒度时钟的精度（通常4ms）时，粗粒度时钟在一个周期内不变，
+    # 无法用来控制节奏，此时改用time.monotonic
+    now = _coarse_now if interval >= _COARSE_RES else time.monotonic
+
+    # 按固定周期发起连接：以截止时间为准计算休眠时长，避免每轮的执行耗时累积成漂移
+    next_deadline = now() + interval
+
+    # 源端口和执行次数都提前组合成一个迭代器，
+    # 循环体内不再判断是否自增端口、是否需要计数
+    src_ports = rotate_ports(src_rotate_port) if src_rotate_port else itertools.repeat(src_port)
+    if count is not None:
+        src_ports = itertools.islice(src_ports, max(count, 0))
+
+    for src_port in src_ports:
+        conn_ns, close_ns, err, local_addr = ping(dst_addr, timeout, src_host, src_port, rst, reuse, delay_close_second)
+        put(conn_ns, not err)
+
+        # 日志级别会过滤掉该条记录时，直接跳过格式化
+        if error_enabled if err else info_enabled:
+            la = f'{local_addr[0]}:{local_addr[1]}, ' if local_addr else ''
+            tmpl = (tmpl_err_early if conn_ns < 0 else tmpl_err) if err else tmpl_ok
+            (log_err if err else log_ok)(tmpl.format(la=la, dst=dst, ct=conn_ns * 1e-9, err=err))
+
+        # 连接间隔，落后超过一个周期时直接以当前时间重新对齐，不再补发
+        sleep_for = next_deadline - now()
+        if sleep_for > 0:
+            sleep(sleep_for)
+            next_deadline += interval
+        elif sleep_for < -interval:
+            next_deadline = now() + interval
+        else:
+            next_deadline += interval
 
 def initial(arguments):
     """
@@ -235,50 +348,73 @@ def my_exit(signum, frame):
     """
     result_string = result.get_statistics()
     mylogger.info(result_string)
+    # exit() 抛出的 SystemExit 会经过主流程的 finally，由那里停止后台日志线程
     exit()
 
 class ResultBucket:
     """存储和计算TCP ping结果统计信息的类"""
     
-    def __init__(self, dst_host, dst_port):
+    def __init__(self, dst_host, dst_port, count=None):
         self.dst_host = dst_host
         self.dst_port = dst_port
-        self.is_initialled = False
+        # 保存每次成功连接的耗时（纳秒）用于计算分位数；
+        # 已知总次数时预先分配以避免运行中扩容，但最多只预分配 _SAMPLES_PREALLOC_MAX 个，
+        # 超出部分再追加，防止很大的 -c 在启动时占满内存
+        self.capacity = min(count, _SAMPLES_PREALLOC_MAX) if count and count > 0 else 0
+        self.samples = array.array('q', [0]) * self.capacity
         self.ok_count = 0
         self.error_count = 0
-        self.min_time = 0.0
-        self.max_time = 0.0
-        self.avg_time = 0.0
+        # 连接时间统一以整数纳秒保存，均值和方差使用 Welford 在线算法累计
+        self.min_ns = 0
+        self.max_ns = 0
+        self.mean = 0.0
+        self.m2 = 0.0
 
-    def put(self, conn_time, status):
+    def put(self, conn_ns, status):
         """
         添加新的结果到桶中
-        :param conn_time: 连接时间
+        :param conn_ns: 连接时间，单位纳秒
         :param status: 连接状态
         """
         if not status:
             self.error_count += 1
+            return
+        n = self.ok_count + 1
+        if n <= self.capacity:
+            self.samples[n - 1] = conn_ns
+        else:
+            self.samples.append(conn_ns)
+        if n == 1:
+            self.min_ns = self.max_ns = conn_ns
         else:
-            if not self.is_initialled:
-                self.min_time = self.max_time = self.avg_time = conn_time
-                self.is_initialled = True
-            else:
-                self.min_time = min(self.min_time, conn_time)
-                self.max_time = max(self.max_time, conn_time)
-                self.avg_time = (self.avg_time * self.ok_count + conn_time) / (self.ok_count + 1)
-            self.ok_count += 1
+            if conn_ns < self.min_ns:
+                self.min_ns = conn_ns
+            if conn_ns > self.max_ns:
+                self.max_ns = conn_ns
+        mean = self.mean
+        delta = conn_ns - mean
+        mean += delta / n
+        self.m2 += delta * (conn_ns - mean)
+        self.mean = mean
+        self.ok_count = n
 
     def get_statistics(self):
-        """返回格式化的统计信息字符串"""
+        """返回格式化的统计信息字符串，时间单位为毫秒"""
         total_count = self.ok_count + self.error_count
         error_rate = self.error_count / total_count * 100 if total_count > 0 else 0
+        mdev_ns = math.sqrt(self.m2 / (self.ok_count - 1)) if self.ok_count > 1 else 0.0
+        p50_ns = p95_ns = p99_ns = self.min_ns
+        if self.ok_count > 1:
+            q = statistics.quantiles(self.samples[:self.ok_count], n=100, method='inclusive')
+            p50_ns, p95_ns, p99_ns = q[49], q[94], q[98]
         return f"""--- {self.dst_host}:{self.dst_port} tcpping statistics ---
 {total_count} connection(s) attempted, {self.ok_count} connected, {error_rate:.2f}% failed
-min/avg/max = {self.min_time:.6f}/{self.avg_time:.6f}/{self.max_time:.6f} ms"""
+min/avg/max/mdev = {self.min_ns / 1e6:.3f}/{self.mean / 1e6:.3f}/{self.max_ns / 1e6:.3f}/{mdev_ns / 1e6:.3f} ms
+p50/p95/p99 = {p50_ns / 1e6:.3f}/{p95_ns / 1e6:.3f}/{p99_ns / 1e6:.3f} ms"""
 
 if __name__ == '__main__':
     args = getargs()
-    result = ResultBucket(args.dst_host[0], args.dst_port[0])
+    result = ResultBucket(args.dst_host[0], args.dst_port[0], args.count)
 
     # 设置输出的日志格式
     console_formatter = logging.Formatter('[%(asctime)s] %(message)s')
@@ -288,10 +424,7 @@ if __name__ == '__main__':
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(console_formatter)
 
-    # 创建logging
-    mylogger = logging.getLogger('tcpping3')
-    mylogger.setLevel(logging.INFO)
-    mylogger.addHandler(console_handler)
+    handlers = [console_handler]
 
     # 判断一下是否需要打log文件
     if args.log:
@@ -300,22 +433,38 @@ if __name__ == '__main__':
             f'tcpping3_{args.dst_host[0]}_{args.dst_port[0]}.log', mode='w',
             maxBytes=10 * 1024 * 1024, backupCount=5)
         file_handler.setFormatter(file_formatter)
-        mylogger.addHandler(file_handler)
-
-    initial(args)
-    # 打印最开始的分隔行
-    mylogger.info('=' * 50)
-    if judge_args(args):
-        give_tips(args)
-        go(args.dst_host[0],
-           args.dst_port[0],
-           timeout=args.timeout,
-           interval=args.interval,
-           src_host=args.src_host,
-           src_port=args.src_port,
-           src_rotate_port=args.src_rotate_port,
-           rst=args.rst,
-           count=args.count,
-           reuse=args.reuse,
-           delay_close_second=args.delay_close_second)
-        mylogger.info(result.get_statistics())
+        handlers.append(file_handler)
+
+    # 创建logging，日志记录只放入队列，由后台线程负责格式化和写屏幕/文件，
+    # 不占用测试循环的时间；使用SimpleQueue，在信号处理函数中写日志也是安全的
+    log_queue = queue.SimpleQueue()
+    mylogger = logging.getLogger('tcpping3')
+    mylogger.setLevel(logging.INFO)
+    mylogger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+
+    # 无论正常结束、收到信号还是出现异常，都要停止后台日志线程，输出完队列中的日志
+    try:
+        initial(args)
+        # 校准计时器开销，后续每次的连接时间都会扣除该值
+        _TIMER_OVERHEAD_NS = calibrate_timer_overhead()
+        mylogger.info(f'[TIMER] perf_counter_ns overhead calibrated: {_TIMER_OVERHEAD_NS} ns')
+        # 打印最开始的分隔行
+        mylogger.info('=' * 50)
+        if judge_args(args):
+            give_tips(args)
+            go(args.dst_host[0],
+               args.dst_port[0],
+               timeout=args.timeout,
+               interval=args.interval,
+               src_host=args.src_host,
+               src_port=args.src_port,
+               src_rotate_port=args.src_rotate_port,
+               rst=args.rst,
+               count=args.count,
+               reuse=args.reuse,
+               delay_close_second=args.delay_close_second)
+            mylogger.info(result.get_statistics())
+    finally:
+        listener.stop()